@@ -1,7 +1,20 @@
 import numpy as np
 import scipy.sparse as sp
 import scipy.linalg as la
-import matplotlib.pyplot as plt
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# specializations with at least this many copies fill their in and out
+# edges with the parallel numba kernel, below it compiling the kernel
+# costs more than it saves
+_NUMBA_MIN_COPIES = 10**6
+# linear dynamics with at least this many iters*nnz multiply-adds are
+# run in the compiled numba kernel instead of scipy's matvec
+_NUMBA_MIN_WORK = 10**8
+
 
 class Graph:
     '''
@@ -22,10 +35,15 @@ class Graph:
     Methods:
         specialize()
         coloring()
+        stability_matrix()
+
+    Unlike DirectedGraph, the dynamics and stability_matrix() weight the
+    input from node j to node i by A[i,j], so pairs of nodes that are
+    not joined by an edge do not affect each other.
 
     '''
 
-    def __init__(self, A, labels=None, F=None):
+    def __init__(self, A, labels=None, F=None, origin=None):
         '''
         Parameters:
             A (ndarray)(n,n): The adjecency matrix to a directed graph
@@ -37,6 +55,9 @@ class Graph:
                 functions describing the network. F[i,i] is the ith 
                 dynamical system and F[i,j] is the input from j to i.
                 None if dynamics are linear
+            origin (ndarray(int))(n,): the index in F of the node each
+                node originates from, defaults to every node being its
+                own origin
         '''
         
         n,m = A.shape
@@ -64,33 +85,40 @@ class Graph:
         self.n = n
         self.labels = labels
         self.indices = np.arange(n)
-        self.labeler = dict(zip(np.arange(n), labels))
-        self.indexer = dict(zip(labels, np.arange(n)))
-        self.origin = self.indexer.copy()
+        # labeler and indexer are only built when they are used
+        self._labeler = None
+        self._indexer = None
         self.F = F
+        self._linear = F is None
+        if origin is None:
+            self._orig_idx = self.indices.copy()
+        else:
+            self._orig_idx = np.asarray(origin, dtype=np.intp)
     
 
-    def _update_indexer(self):
+    @property
+    def labeler(self):
         '''
-        This function assumes that self.labeler is correct in its
-        labeling and returns a new indexer based on that
+        dict(int, str): maps indices to labels, built from self.labels
+        the first time it is needed
         '''
 
-        indices = self.labeler.keys()
-        labels = self.labeler.values()
-        return dict(zip(labels, indices))
+        if self._labeler is None:
+            self._labeler = dict(zip(self.indices, self.labels))
+        return self._labeler
 
 
-    def _update_labeler(self):
+    @property
+    def indexer(self):
         '''
-        This function assumers that self.indexer is correct in its
-        indexing and returns a new labeler based on that
+        dict(str, int): maps labels to indices, built from self.labels
+        the first time it is needed
         '''
 
-        labels = self.indexer.keys()
-        indices = self.indexer.values()
-        return dict(zip(indices, labels))
-        
+        if self._indexer is None:
+            self._indexer = dict(zip(self.labels, self.indices))
+        return self._indexer
+
 
     def specialize(self, base):
         '''
@@ -119,64 +147,125 @@ class Graph:
             raise ValueError('base list is too long')
 
         # permute A so that it is block diagonal with the base first
-        spec_set = [i for i in self.indices if i not in base]
-        permute = base + spec_set
-
-        # Change the labeler and update the indexer
-        self.labeler = {i : self.labeler[permute[i]] for i in range(self.n)}
-        self.indexer = self._update_indexer()
-        self.labels = [self.labels[i] for i in permute]
-
-
-        # rearrange the indices to put the base set first
-        self.A = self.A[permute,:][:,permute]
-
-        # count the number of way into and out of the specialization set
+        mask = np.ones(self.n, dtype=bool)
+        mask[np.asarray(base, dtype=np.intp)] = False
+        spec_set = np.flatnonzero(mask)
+        permute = np.concatenate([np.asarray(base, dtype=np.intp), spec_set])
+
+        A = self.A.tocoo()
+        rows, cols, data = A.row, A.col, A.data
+
+        # the base set is often already first, e.g. after a previous
+        # specialization, in which case there is nothing to permute
+        if not np.array_equal(permute, self.indices):
+            # reorder the labels, the labeler and indexer are rebuilt
+            # from them if they are needed again
+            self.labels = [self.labels[i] for i in permute]
+            self._labeler = None
+            self._indexer = None
+            self._orig_idx = self._orig_idx[permute]
+
+            # rearrange the indices to put the base set first, this is
+            # the symmetric permutation P A P^T done in one pass over the
+            # edges
+            inverse = np.empty(self.n, dtype=np.intp)
+            inverse[permute] = np.arange(self.n)
+            rows, cols = inverse[rows], inverse[cols]
+            self.A = sp.coo_matrix(
+                (data, (rows, cols)), shape=(self.n,self.n)).tocsr()
+
+        # split the edges into the base block, the specialization block
+        # and the edges into and out of the specialization set
         base_len = len(base)
         spec_len = len(spec_set)
-        in_graph = self.A[base_len:,:][:,:base_len]
-        out_graph = self.A[:base_len,:][:,base_len:]
-        num_in = in_graph.sum()
-        num_out = out_graph.sum()
-        num_copies = int(num_in * num_out)
-        in_edges = np.argwhere(in_graph != 0)
-        out_edges = np.argwhere(out_graph != 0)
-
-
-        # create the new specialized matrix as a sparse diagonal matrix
-        S = sp.block_diag(
-            [self.A[:base_len,:][:,:base_len]] + 
-            [self.A[base_len:,:][:,base_len:]]*num_copies,
-            format='lil'
-        )
+        base_rows = rows < base_len
+        base_cols = cols < base_len
+        in_block = ~base_rows & base_cols & (data != 0)
+        out_block = base_rows & ~base_cols & (data != 0)
+        base_block = base_rows & base_cols
+        spec_block = ~base_rows & ~base_cols
+
+        # edges are kept relative to the corner of their block and the
+        # in and out edges are sorted by row, then column, since this
+        # decides the order the copies are made in
+        in_rows, in_cols = rows[in_block] - base_len, cols[in_block]
+        order = np.lexsort((in_cols, in_rows))
+        in_rows, in_cols = in_rows[order], in_cols[order]
+        in_weights = data[in_block][order]
+        out_rows, out_cols = rows[out_block], cols[out_block] - base_len
+        order = np.lexsort((out_cols, out_rows))
+        out_rows, out_cols = out_rows[order], out_cols[order]
+        out_weights = data[out_block][order]
+
+        # every pair of an edge into and an edge out of the
+        # specialization set gets its own copy of the specialization set
+        n_in, n_out = len(in_weights), len(out_weights)
+        num_copies = n_in * n_out
+
+
+        # the specialized matrix is assembled from COO triples, first the
+        # base block, then every copy of the specialization block, then
+        # one in and one out edge per copy
+        size = base_len + num_copies*spec_len
+        base_nnz = np.count_nonzero(base_block)
+        spec_nnz = np.count_nonzero(spec_block)
+        diag_nnz = base_nnz + num_copies*spec_nnz
+        nnz = diag_nnz + 2*num_copies
+        S_rows = np.empty(nnz, dtype=np.intp)
+        S_cols = np.empty(nnz, dtype=np.intp)
+        S_data = np.empty(nnz, dtype=self.A.dtype)
+
+        # every copy of the specialization set is the same block shifted
+        # down the diagonal so we only need its COO triples once
+        offsets = base_len + np.arange(num_copies)*spec_len
+        S_rows[:base_nnz] = rows[base_block]
+        S_cols[:base_nnz] = cols[base_block]
+        S_data[:base_nnz] = data[base_block]
+        S_rows[base_nnz:diag_nnz].reshape(num_copies, spec_nnz)[:] = (
+            rows[spec_block][None,:] - base_len + offsets[:,None])
+        S_cols[base_nnz:diag_nnz].reshape(num_copies, spec_nnz)[:] = (
+            cols[spec_block][None,:] - base_len + offsets[:,None])
+        S_data[base_nnz:diag_nnz].reshape(num_copies, spec_nnz)[:] = (
+            data[spec_block])
 
         # fill in the in and out edges
-        # this step is O(in_edges * out_edges) <<< O(m)
-        i = 0
-        for in_edge in in_edges:
-            for out_edge in out_edges:
-
-                base_offset = base_len + i*spec_len
-                in_offset = base_offset+in_edge[0]
-                out_offset = base_offset+out_edge[1]
-
-                S[in_offset,in_edge[1]] = in_graph[in_edge[0],in_edge[1]]
-                S[out_edge[0],out_offset] = out_graph[out_edge[0],out_edge[1]]
-
-                i += 1
-
-        S = S.tocsr()
+        # copy k is made from in edge k // n_out and out edge k % n_out
+        if numba is not None and num_copies >= _NUMBA_MIN_COPIES:
+            _fill_edges(
+                in_rows, in_cols, in_weights,
+                out_rows, out_cols, out_weights,
+                base_len, spec_len,
+                S_rows[diag_nnz:], S_cols[diag_nnz:], S_data[diag_nnz:]
+            )
+        else:
+            in_slice = slice(diag_nnz, diag_nnz + num_copies)
+            out_slice = slice(diag_nnz + num_copies, nnz)
+            S_rows[in_slice] = offsets + np.repeat(in_rows, n_out)
+            S_cols[in_slice] = np.repeat(in_cols, n_out)
+            S_data[in_slice] = np.repeat(in_weights, n_out)
+            S_rows[out_slice] = np.tile(out_rows, n_in)
+            S_cols[out_slice] = offsets + np.tile(out_cols, n_in)
+            S_data[out_slice] = np.tile(out_weights, n_in)
+
+        S = sp.coo_matrix(
+            (S_data, (S_rows, S_cols)), shape=(size,size)).tocsr()
         
         # update all the attributes
-        labels = self.labels[:base_len] + [None]*num_copies*spec_len
-        for i in range(num_copies):
-            for j in range(spec_len):
-                copy_index = base_len+i*spec_len+j
-                orig_index = base_len+j
-                labels[copy_index] = self.labels[orig_index] + f'.{i+1}'
-        
+        # the jth node of the ith copy is labeled by '<label>.<i+1>'
+        suffixes = np.char.add('.', np.arange(1, num_copies+1).astype(str))
+        spec_labels = np.array(self.labels[base_len:], dtype=object)
+        copy_labels = spec_labels[None,:] + suffixes[:,None].astype(object)
+        labels = self.labels[:base_len] + copy_labels.ravel().tolist()
+
 
-        return Graph(S,labels)
+        # the copies originate from the same nodes as the
+        # specialization set they were copied from
+        orig = np.concatenate([
+            self._orig_idx[:base_len],
+            np.tile(self._orig_idx[base_len:], num_copies)
+        ])
+
+        return Graph(S, labels, self.F, origin=orig)
     
     def original(self, i):
         """
@@ -189,19 +278,36 @@ class Graph:
             o_i (int): the original index of i
         """
 
-        label = self.labeler[i]
-        # find the first entry in the node's label
-        temp_ind = label.find('.')
-        # if it is not the original label we use temp_ind
-        if temp_ind != -1:
-            label = label[:temp_ind]
-        return self.origin[label]
+        return self._orig_idx[i]
     
+    def _edges(self):
+        '''
+        Returns the nonzero edges of the network that are not self
+        edges, self edges are handled by the node dynamics F[o_i,o_i]
+
+        Returns:
+            rows (ndarray(int)): receiving node of each edge
+            cols (ndarray(int)): sending node of each edge
+            weights (ndarray): weight of each edge
+        '''
+
+        # explicitly stored zeros are not edges
+        A = self.A.tocoo()
+        edges = (A.row != A.col) & (A.data != 0)
+        return A.row[edges], A.col[edges], A.data[edges]
+
     def _set_dynamics(self):
         '''
         Create the matrix valued function that models the dynamics of
         the network
 
+        The ith component of the network function is
+            F[o_i,o_i](x[i]) + sum_j A[i,j]*F[o_i,o_j](x[j])
+        where the sum runs over the edges of A. The edges are grouped
+        by the (o_i,o_j) pair they originate from so that each of the
+        original functions is evaluated once per timestep on every edge
+        that shares it.
+
         Implicit Parameters:
             self.F (mxm matrix valued function): this describes the
                 independent influence the jth node has on the ith node
@@ -214,35 +320,30 @@ class Graph:
                 and returns the state of the nodes at the next time step
         '''
 
-        def create_component_function(i, o_i):
-            '''Returns the ith component function of the network'''
-
-            def compt_func(x):
-                n = self.n
-                return np.sum(
-                        [
-                        self.F[o_i,self.original(j)](x[j]) for j in range(n)
-                        ]
-                    )
-            return compt_func
+        orig = self._orig_idx
 
-        # initialize the output array
-        F = [None]*self.n
+        rows, cols, weights = self._edges()
 
-        for i in range(self.n):
-            o_i = self.original(i)
-            # for each node we create a component function that works 
-            # much like matrix multiplication
-            F[i] = create_component_function(i, o_i)
+        # group the edges and nodes by the function that acts on them
+        m = len(self.F)
+        edge_groups = _group_by_function(
+            self.F, orig[rows], orig[cols], m)
+        node_groups = _group_by_function(self.F, orig, orig, m)
 
-        # return a vector valued function that can be used for iteration
         def G(t):
-            return np.array([F[k](t) for k in range(self.n)])
+            t = np.asarray(t, dtype=float)
+            vals = np.empty(len(rows))
+            for f, idx in edge_groups:
+                vals[idx] = _evaluate(f, t[cols[idx]])
+            x = np.bincount(rows, weights=weights*vals, minlength=self.n)
+            for f, idx in node_groups:
+                x[idx] += _evaluate(f, t[idx])
+            return x
         return G
 
     def iterate(
         self, iters, initial_condition,
-        graph=False, save_img=False, title=None):
+        graph=False, save_img=False, title=None, device='cpu'):
         '''
         Model the dynamics on the network for iters timesteps given an
         initial condition
@@ -253,13 +354,20 @@ class Graph:
             graph (bool): will graph states of nodes over time if True
             save_img (bool): saves image with file name title if True
             title (str): filename of the image if save_img == True
+            device (str): 'cpu', or 'cuda' to run linear dynamics on
+                the GPU with CuPy
         Returns:
             t (ndarray)(iters,n): the states of each node at every time
                 step
         '''
 
-        if np.any(self.F == None):
-            t = self._linear_dynamics(iters, initial_condition)
+        if device not in ('cpu', 'cuda'):
+            raise ValueError("device must be either 'cpu' or 'cuda'")
+        if device == 'cuda' and not self._linear:
+            raise ValueError('only linear dynamics can be run on cuda')
+
+        if self._linear:
+            t = self._linear_dynamics(iters, initial_condition, device)
         
         else:
             F = self._set_dynamics()
@@ -275,6 +383,9 @@ class Graph:
 
             
         if graph:
+            # matplotlib is only loaded when the dynamics are plotted
+            import matplotlib.pyplot as plt
+
             domain = np.arange(iters)
             for i in range(self.n):
                 plt.plot(domain, t[:,i], label=self.labeler[i], lw=2)
@@ -289,7 +400,7 @@ class Graph:
 
         return t
 
-    def _linear_dynamics(self, iters, initial_condition):
+    def _linear_dynamics(self, iters, initial_condition, device='cpu'):
         '''
         Model the networks given that the system is defined by a
         adjacency matrix.
@@ -297,15 +408,201 @@ class Graph:
         Paramters:
             iters (int): number of timsteps to be simulated
             initial_condition (ndarray): initial conditions of the nodes
+            device (str): 'cpu', or 'cuda' to iterate on the GPU
         Returns:
             x (ndarray): the states of each node at every time step
         '''
 
+        if device == 'cuda':
+            return self._cuda_linear_dynamics(iters, initial_condition)
+
         t = np.zeros((iters,self.n))
 
         t[0] = initial_condition
 
-        for i in range(1,iters):
-            t[i] = self.A@t[i-1]
+        # long runs on large networks are done in one compiled kernel
+        # when numba is available, otherwise we use scipy's matvec
+        if numba is not None and iters*self.A.nnz >= _NUMBA_MIN_WORK:
+            # fixed dtypes so the kernel is only compiled once
+            _csr_iterate(
+                self.A.indptr.astype(np.int64),
+                self.A.indices.astype(np.int64),
+                self.A.data.astype(float), t
+            )
+        else:
+            for i in range(1,iters):
+                t[i] = self.A@t[i-1]
         
         return t
+
+    def _cuda_linear_dynamics(self, iters, initial_condition):
+        '''
+        Same as _linear_dynamics but A and the states stay on the GPU
+        for every timestep and are only copied back at the end, needs
+        CuPy
+        '''
+
+        try:
+            import cupy
+            import cupyx.scipy.sparse
+        except ImportError as err:
+            raise ValueError("device='cuda' requires CuPy") from err
+
+        A = cupyx.scipy.sparse.csr_matrix(self.A.astype(float))
+        t = cupy.zeros((iters,self.n))
+
+        t[0] = cupy.asarray(initial_condition)
+
+        for i in range(1,iters):
+            t[i] = A@t[i-1]
+
+        return cupy.asnumpy(t)
+
+    def stability_matrix(self):
+        '''
+        Returns the stability matrix of the network
+
+        Each supremum is estimated on [-10,10] from a coarse grid that is
+        refined around its largest sample.
+
+        Returns:
+            Df (ndarray)(n,n)(float32): the stability matrix of the
+                network where the i,j entry is the supremum of the
+                absolute value of the partial of the ith component
+                function with respect to the jth node, i.e.
+                |A[i,j]|*sup|F[o_i,o_j]'| off the diagonal and
+                sup|F[o_i,o_i]'| on it
+        '''
+
+        # linear dynamics are their own jacobian
+        if self._linear:
+            return np.abs(self.A.toarray()).astype(np.float32)
+
+        samples = 8192
+        domain = np.linspace(-10,10,samples)
+        orig = self._orig_idx
+        rows, cols, weights = self._edges()
+        m = len(self.F)
+
+        # many (o_i,o_j) pairs share a function, so we only differentiate
+        # each distinct function once
+        sups = dict()
+        def sup(f):
+            if id(f) not in sups:
+                # derivatives of steep functions such as tanh(50*x) are
+                # computed as g/cosh(x)**2, which overflows to g/inf = 0
+                # far from the transition, that limit is the right value
+                with np.errstate(over='ignore'):
+                    _range = np.abs(_derivative(f, domain))
+                    k = np.argmax(_range)
+                    # sample the neighborhood of the coarse maximum finely
+                    fine = np.linspace(
+                        domain[max(k-1, 0)], domain[min(k+1, samples-1)],
+                        samples
+                    )
+                    sups[id(f)] = max(
+                        _range[k], np.max(np.abs(_derivative(f, fine))))
+            return sups[id(f)]
+
+        Df = np.zeros((self.n,self.n), dtype=np.float32)
+        for f, idx in _group_by_function(
+                self.F, orig[rows], orig[cols], m):
+            Df[rows[idx],cols[idx]] = np.abs(weights[idx])*sup(f)
+        for f, idx in _group_by_function(self.F, orig, orig, m):
+            Df[idx,idx] = sup(f)
+
+        return Df
+
+
+def _group_by_function(F, o_rows, o_cols, m):
+    '''
+    Group the index pairs (o_rows[k], o_cols[k]) by the entry of F
+    they refer to
+
+    Parameters:
+        F (ndarray)(m,m)(function): the network's function matrix
+        o_rows (ndarray(int)): original row index of each entry
+        o_cols (ndarray(int)): original column index of each entry
+        m (int): the original number of nodes
+    Returns:
+        groups (list(tuple(function, ndarray(int)))): the function
+            F[o_i,o_j] paired with the positions k that use it
+    '''
+
+    pairs, inverse = np.unique(o_rows*m + o_cols, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    splits = np.cumsum(np.bincount(inverse, minlength=len(pairs)))[:-1]
+    return [
+        (F[pair // m, pair % m], idx)
+        for pair, idx in zip(pairs, np.split(order, splits))
+    ]
+
+
+def _evaluate(f, x):
+    '''
+    Evaluate the scalar function f at every entry of x, falling back
+    to a python loop if f does not accept arrays
+    '''
+
+    try:
+        return np.broadcast_to(f(x), x.shape)
+    except (TypeError, ValueError):
+        return np.array([f(xi) for xi in x], dtype=float)
+
+
+def _derivative(f, x):
+    '''
+    Evaluate the derivative of the scalar function f at every entry of
+    x with autograd, falling back to a python loop if f does not accept
+    arrays
+    '''
+
+    # autograd is only loaded when a derivative is needed
+    import autograd as ag
+
+    try:
+        return np.broadcast_to(ag.elementwise_grad(f)(x), x.shape)
+    except (TypeError, ValueError):
+        df = ag.grad(f)
+        return np.array([df(xi) for xi in x], dtype=float)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _csr_iterate(indptr, indices, data, t):
+        '''
+        Fill t[1:] in place with t[i] = A@t[i-1], where A is the CSR
+        matrix given by (data, indices, indptr)
+        '''
+
+        iters, n = t.shape
+        for i in range(1, iters):
+            for row in numba.prange(n):
+                total = 0.0
+                for k in range(indptr[row], indptr[row+1]):
+                    total += data[k]*t[i-1, indices[k]]
+                t[i, row] = total
+        return t
+
+    @numba.njit(parallel=True, cache=True)
+    def _fill_edges(
+            in_rows, in_cols, in_weights,
+            out_rows, out_cols, out_weights,
+            base_len, spec_len, rows, cols, data):
+        '''
+        Write the in and out edge of every copy of the specialization
+        set into the COO arrays (rows, cols, data), the kth copy uses
+        in edge k // len(out_rows) and out edge k % len(out_rows)
+        '''
+
+        n_out = len(out_rows)
+        for k in numba.prange(len(in_rows)*n_out):
+            i = k // n_out
+            j = k % n_out
+            offset = base_len + k*spec_len
+            rows[2*k] = offset + in_rows[i]
+            cols[2*k] = in_cols[i]
+            data[2*k] = in_weights[i]
+            rows[2*k+1] = out_rows[j]
+            cols[2*k+1] = offset + out_cols[j]
+            data[2*k+1] = out_weights[j]
@@ -0,0 +1,51 @@
+import sys
+import os
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core.subgraph_specializer as s
+import numpy as np
+
+if __name__ == "__main__":
+
+    def sig(x):
+        return np.tanh(x)
+    def lin(x):
+        return .5*x
+    def logistic(x):
+        x = x % 1
+        return 4*x*(1-x)
+    def zero(x):
+        return 0*x
+
+    # unweighted graph whose functions are zero wherever there is no edge
+    A = np.array([
+        [0,1,1,0],
+        [1,0,1,1],
+        [0,1,0,1],
+        [1,0,1,0]
+    ])
+    F = np.array([
+        [logistic,sig,lin,zero],
+        [sig,sig,lin,sig],
+        [zero,lin,logistic,sig],
+        [sig,zero,lin,sig]
+    ])
+
+    # the formula used before the dynamics were restricted to the edges
+    # of A, every node receives F[i,j](x[j]) from every node j
+    def old_step(x):
+        n = len(x)
+        return np.array([
+            np.sum([F[i,j](x[j]) for j in range(n)]) for i in range(n)
+        ])
+
+    iters = 20
+    x0 = np.random.random(4)
+    t = np.zeros((iters,4))
+    t[0] = x0
+    for i in range(1,iters):
+        t[i] = old_step(t[i-1])
+
+    G = s.Graph(A, F=F)
+    assert np.allclose(G.iterate(iters, x0), t)
+    print('edge dynamics match the old formula')
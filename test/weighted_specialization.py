@@ -0,0 +1,25 @@
+import sys
+import os
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core.subgraph_specializer as s
+import numpy as np
+
+if __name__ == "__main__":
+
+    # one edge into and one edge out of the specialization set, so the
+    # specialization gets exactly one copy whatever the weights are
+    A = np.array([
+        [0,2,0],
+        [3,0,0],
+        [0,0,0]
+    ])
+
+    G = s.Graph(A)
+    S = G.specialize([0])
+
+    assert S.n == 3, S.n
+    assert S.labels == ['0', '1.1', '2.1'], S.labels
+    # the weights are carried over to the copy
+    assert np.array_equal(S.A.toarray(), A), S.A.toarray()
+    print('weighted specialization gives one copy')